@@ -13,12 +13,12 @@ batch_parquet_pattern = re.compile('batch_([0-9]+).parquet')
 
 def process_chunk(part_path: Path, endpoints_path: Path, imputation_for_endpoints_path: Path,
                   output_dir: Path, static_path: Path,
-                  horizon):
+                  horizon, workers=1):
     batch_id = int(re.match(batch_parquet_pattern, part_path.name).groups()[0])
 
     label_benchmark.label_gen_benchmark(batch_id=batch_id, label_path=output_dir, endpoint_path=endpoints_path,
                                         imputed_path=imputation_for_endpoints_path, static_path=static_path,
-                                        horizon=horizon)
+                                        horizon=horizon, workers=workers)
 
 
 def generate_labels(endpoints_path: Path, imputation_for_endpoints_path: Path,
@@ -28,10 +28,13 @@ def generate_labels(endpoints_path: Path, imputation_for_endpoints_path: Path,
     output_ds = Dataset(output_dir)
     output_ds.prepare()
 
+    # Batches are labelled in parallel, a single batch has its patients labelled in parallel instead
+    batch_workers, patient_workers = (1, nr_workers) if len(parts) == 1 else (nr_workers, 1)
+
     processing.exec_parallel_on_parts(functools.partial(process_chunk, endpoints_path=endpoints_path,
                                                         imputation_for_endpoints_path=imputation_for_endpoints_path,
                                                         output_dir=output_dir, static_path=exended_general_data_path,
-                                                        horizon=horizon),
-                                      parts, nr_workers)
+                                                        horizon=horizon, workers=patient_workers),
+                                      parts, batch_workers)
 
     output_ds.mark_done()
@@ -0,0 +1,69 @@
+""" Numba compiled versions of the per time-step labelling loops of icu_benchmarks.labels.utils"""
+
+import numpy as np
+from numba import njit
+
+from icu_benchmarks.common.constants import STEPS_PER_HOUR, BINARY_TSH_URINE
+
+
+@njit(cache=True, error_model="numpy")
+def get_hr_status(hr_col):
+    """Return a presence feature on HR given the cumulative counts of HR, see utils.get_hr_status"""
+    hr_status_arr = np.zeros_like(hr_col)
+    for jdx in range(hr_col.size):
+        low_idx = max(0, jdx - 2)
+        high_idx = min(hr_col.size - 1, jdx + 2)
+        if high_idx > low_idx and hr_col[high_idx - 1] - hr_col[low_idx] > 0:
+            hr_status_arr[jdx] = 1
+    return hr_status_arr
+
+
+@njit(cache=True, error_model="numpy")
+def transition_to_failure(ann_col, lhours, rhours):
+    """ Transition to failure defined on a binary annotation column, see utils.transition_to_failure"""
+    out_arr = np.zeros_like(ann_col)
+
+    # First failure index at or after each time-step, the look-ahead window is then checked in constant time
+    next_failure = np.empty(ann_col.size + 1, dtype=np.int64)
+    next_failure[ann_col.size] = ann_col.size
+    for jdx in range(ann_col.size - 1, -1, -1):
+        next_failure[jdx] = jdx if ann_col[jdx] == 1 else next_failure[jdx + 1]
+
+    for jdx in range(ann_col.size):
+        if np.isnan(ann_col[jdx]) or ann_col[jdx] == 1:
+            out_arr[jdx] = np.nan
+        elif ann_col[jdx] == 0:
+            low_idx = min(ann_col.size, jdx + 1 + lhours * STEPS_PER_HOUR)
+            high_idx = min(ann_col.size, jdx + 1 + rhours * STEPS_PER_HOUR)
+            if next_failure[low_idx] < high_idx:
+                out_arr[jdx] = 1
+    return out_arr
+
+
+@njit(cache=True, error_model="numpy")
+def future_urine_output(urine_col, urine_meas_arr, weight_col, rhours):
+    """ Regression and binary classification problems on urine output in the future, see utils.future_urine_output"""
+    reg_out_arr = np.zeros_like(urine_col)
+    binary_out_arr = np.zeros_like(urine_col)
+
+    for jdx in range(urine_col.size):
+
+        # No valid urine measurement anchor in 2 hours, the task is invalid
+        measurement_idx = min(jdx + STEPS_PER_HOUR * rhours, urine_col.size - 1)
+        end_of_stay_before_2h = measurement_idx == urine_col.size - 1
+        if end_of_stay_before_2h or urine_meas_arr[measurement_idx] - urine_meas_arr[measurement_idx - 1] <= 0:
+            binary_out_arr[jdx] = np.nan
+            reg_out_arr[jdx] = np.nan
+            continue
+
+        cum_increase = 0.0
+        for kdx in range(jdx + 1, min(jdx + rhours * STEPS_PER_HOUR + 1, urine_col.size)):
+            cum_increase += urine_col[kdx]
+        std_cum_increase = cum_increase / (weight_col[jdx] * STEPS_PER_HOUR * rhours)
+        reg_out_arr[jdx] = std_cum_increase
+
+        # More than 0.5 ml/kg/h
+        if std_cum_increase >= BINARY_TSH_URINE:
+            binary_out_arr[jdx] = 1.0
+
+    return reg_out_arr, binary_out_arr
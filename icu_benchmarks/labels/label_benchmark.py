@@ -1,19 +1,43 @@
 """ Label generation from the benchmark endpoints"""
 
-import gc
+import functools
 import glob
+import itertools
 import logging
+import multiprocessing
 import os
 import os.path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+import icu_benchmarks.labels.kernels as kernels
 import icu_benchmarks.labels.utils as utils
 from icu_benchmarks.common.constants import PID, MORTALITY_NAME, CIRC_FAILURE_NAME, RESP_FAILURE_NAME, URINE_REG_NAME, \
     URINE_BINARY_NAME, PHENOTYPING_NAME, LOS_NAME, STEPS_PER_HOUR, DATETIME, REL_DATETIME, HR_CUM_NAME, APACHE_2_NAME, \
     APACHE_4_NAME, URINE_CUM_NAME, DISCHARGE_NAME, VAR_IDS_EP, APACHE_2_MAP, APACHE_4_MAP
 
+# Only the columns used by the labelling are read from the batch files
+IMPUTED_COLUMNS = [PID, DATETIME, REL_DATETIME, HR_CUM_NAME, URINE_CUM_NAME, VAR_IDS_EP['Weight'][0],
+                   VAR_IDS_EP['Urine_cum']]
+ENDPOINT_COLUMNS = [PID, DATETIME, "circ_failure_status", "resp_failure_status"]
+STATIC_COLUMNS = [PID, DISCHARGE_NAME, APACHE_2_NAME, APACHE_4_NAME]
+
+# Labels with few distinct values, dictionary encoded in the label files
+CLASS_LABEL_NAMES = [MORTALITY_NAME, PHENOTYPING_NAME]
+
+# Number of rows decoded at once when streaming the batch files
+READ_BATCH_SIZE = 131072
+
+# Number of patients submitted at once to the process pool, bounds the number of patients held in memory
+PATIENT_CHUNK_SIZE = 1000
+
+# Minimal number of label rows per row group of the label files
+WRITE_ROW_GROUP_SIZE = 100000
+
 
 def delete_if_exist(path):
     """ Deletes a path if it exists on the file-system"""
@@ -21,156 +45,308 @@ def delete_if_exist(path):
         os.remove(path)
 
 
+def read_contiguous_pids(path):
+    """Returns the patient IDs of a parquet file in file order.
+
+    Raises a ValueError if the rows of a patient are not contiguous, as required to stream the file per patient.
+    """
+    pids = pd.read_parquet(path, columns=[PID])[PID].to_numpy()
+    unique_pids = pd.unique(pids)
+    n_pid_runs = np.count_nonzero(pids[1:] != pids[:-1]) + 1 if len(pids) > 0 else 0
+    if n_pid_runs != len(unique_pids):
+        raise ValueError("Rows of patients are not contiguous in {}".format(path))
+    return unique_pids
+
+
+def iter_patient_frames(path, columns, batch_size=READ_BATCH_SIZE, sort_by=None):
+    """Yields (pid, df_pat) for each patient of a parquet file whose patients are stored in contiguous rows.
+
+    The next record batch is read in a background thread while the current one is being consumed. If sort_by is
+    given, the rows of each patient are sorted by this column, once per record batch.
+    """
+    record_batches = pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+    seen_pids = set()
+    df_tail = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(next, record_batches, None)
+        while True:
+            record_batch = next_batch.result()
+            if record_batch is None:
+                break
+            next_batch = executor.submit(next, record_batches, None)
+
+            df = record_batch.to_pandas()
+            if df_tail is not None:
+                df = pd.concat([df_tail, df], ignore_index=True)
+            pids = df[PID].values
+            starts = np.concatenate([[0], np.flatnonzero(pids[1:] != pids[:-1]) + 1])
+            if sort_by is not None:
+                df = sort_within_patients(df, starts, sort_by)
+
+            # The last patient of a batch may continue in the next one
+            for start, end in zip(starts[:-1], starts[1:]):
+                yield _checked_patient_frame(df.iloc[start:end], seen_pids, path)
+            df_tail = df.iloc[starts[-1]:]
+
+    if df_tail is not None and df_tail.shape[0] > 0:
+        yield _checked_patient_frame(df_tail, seen_pids, path)
+
+
+def sort_within_patients(df, starts, colname):
+    """Stable sort of the rows of each patient by a column, patients are contiguous and start at the given rows"""
+    values = df[colname].to_numpy()
+    patient_idx = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(df))))
+    if np.all((values[1:] >= values[:-1]) | (patient_idx[1:] != patient_idx[:-1])):
+        return df
+    return df.iloc[np.lexsort((values, patient_idx))].reset_index(drop=True)
+
+
+def _checked_patient_frame(df_pat, seen_pids, path):
+    pid = df_pat[PID].values[0]
+    if pid in seen_pids:
+        raise ValueError("Rows of patient {} are not contiguous in {}".format(pid, path))
+    seen_pids.add(pid)
+    return pid, df_pat
+
+
+class PatientFrameStream:
+    """Lookup of per-patient data-frames streamed from a parquet file.
+
+    Patients requested in file order are served without buffering, others are copied and buffered until requested.
+    If pids is given, patients outside of it are dropped as they are read. The file is only read as far as needed,
+    contiguity of the patients must be checked beforehand with read_contiguous_pids.
+    """
+
+    def __init__(self, path, columns, sort_by=None, pids=None):
+        self._frames = iter_patient_frames(path, columns, sort_by=sort_by)
+        self._pids = None if pids is None else set(pids)
+        self._buffered = {}
+
+    def get(self, pid):
+        """Returns the data-frame of a patient, or None if the patient is not in the file"""
+        while pid not in self._buffered:
+            try:
+                next_pid, df_pat = next(self._frames)
+            except StopIteration:
+                return None
+            if next_pid == pid:
+                return df_pat
+            # Frames are views on their record batch, buffered ones are copied to not keep the batch alive
+            if self._pids is None or next_pid in self._pids:
+                self._buffered[next_pid] = df_pat.copy()
+        return self._buffered.pop(pid)
+
+
 def is_df_sorted(df, colname):
-    return (np.array(df[colname].diff().dropna(), dtype=np.float64) >= 0).all()
+    """Checks whether a column of a data-frame is sorted in non-decreasing order"""
+    arr = df[colname].to_numpy()
+    if arr.size < 2:
+        return True
+    return bool(np.all(arr[1:] >= arr[:-1]))
+
 
+@functools.lru_cache(maxsize=32)
+def remaining_los(stay_length):
+    """Remaining length of stay in hours at each time-step, shared between stays of equal length and read-only"""
+    rem_los = np.linspace(stay_length / STEPS_PER_HOUR, 0, num=stay_length, dtype=np.float32)
+    rem_los.flags.writeable = False
+    return rem_los
 
-def gen_label(df_pat, df_endpoint, horizon, mort_status=None, apache_group=None, pid=None):
-    """Returns data-frame with label from patient input data-frames"""
+
+def gen_label(df_pat, df_endpoint, horizon, mort_status=None, apache_group=None, pid=None, debug_mode=False):
+    """Returns arrow table with label from patient input data-frames"""
 
     abs_time_col = df_pat[DATETIME]
     rel_time_col = df_pat[REL_DATETIME]
     patient_col = df_pat[PID]
     stay_length = len(rel_time_col)
 
-    hr_col = np.array(df_pat[HR_CUM_NAME])
-    hr_status_arr = utils.get_hr_status(hr_col)
+    # Labels are computed in single precision, the inputs are counts and clinical measurements
+    hr_col = df_pat[HR_CUM_NAME].to_numpy(dtype=np.float32, copy=False)
+    hr_status_arr = kernels.get_hr_status(hr_col)
 
     if df_pat.shape[0] == 0 or df_endpoint.shape[0] == 0:
-        logging.info("WARNING: Patient {} has no impute data, skipping...".format(pid), flush=True)
+        logging.info("WARNING: Patient %s has no impute data, skipping...", pid)
         return None
 
-    df_endpoint.set_index(keys=DATETIME, inplace=True, verify_integrity=True)
-    assert ((df_pat[DATETIME] == df_endpoint.index).all())
-
-    output_df_dict = {}
-    output_df_dict[DATETIME] = abs_time_col
-    output_df_dict[REL_DATETIME] = rel_time_col
-    output_df_dict[PID] = patient_col
+    # Imputed data and endpoints share the same time grid, rows are matched by position
+    if df_pat.shape[0] != df_endpoint.shape[0]:
+        raise ValueError("Patient {} has {} imputed rows but {} endpoint rows".format(pid, df_pat.shape[0],
+                                                                                   df_endpoint.shape[0]))
+    if debug_mode:
+        assert np.array_equal(df_pat[DATETIME].values, df_endpoint[DATETIME].values)
 
     # Mortality, predicted after the first 24h
     dynamic_mort_arr = utils.unique_label_at_hours(stay_length, mort_status, at_hours=24)
-    dynamic_mort_arr = utils.convolve_hr(dynamic_mort_arr, hr_status_arr)
-    output_df_dict[MORTALITY_NAME] = dynamic_mort_arr
 
     # Circulatory Failure, predicted every 5min
-    circ_failure_col = np.array(df_endpoint.circ_failure_status)
-    dynamic_circ_failure = utils.transition_to_failure(circ_failure_col, lhours=0, rhours=horizon)
-    dynamic_circ_failure = utils.convolve_hr(dynamic_circ_failure, hr_status_arr)
-    output_df_dict[CIRC_FAILURE_NAME + '_' + str(horizon) + 'Hours'] = dynamic_circ_failure
+    circ_failure_col = df_endpoint.circ_failure_status.to_numpy(dtype=np.float32, copy=False)
+    dynamic_circ_failure = kernels.transition_to_failure(circ_failure_col, 0, horizon)
 
     # Respiratory Failure, predicted every 5min
-    pre_resp_arr = df_endpoint.resp_failure_status.values
-    ann_resp_arr = utils.get_any_resp_label(pre_resp_arr)
-    dynamic_resp_failure = utils.transition_to_failure(ann_resp_arr, lhours=0, rhours=horizon)
-    dynamic_resp_failure = utils.convolve_hr(dynamic_resp_failure, hr_status_arr)
-    output_df_dict[RESP_FAILURE_NAME + '_' + str(horizon) + 'Hours'] = dynamic_resp_failure
+    pre_resp_arr = df_endpoint.resp_failure_status.to_numpy(copy=False)
+    ann_resp_arr = np.asarray(utils.get_any_resp_label(pre_resp_arr), dtype=np.float32)
+    dynamic_resp_failure = kernels.transition_to_failure(ann_resp_arr, 0, horizon)
 
     # Urine in the next 2h, (Cont. regression) or (Binary below 0.5)
-    weight_col = np.array(df_pat[VAR_IDS_EP['Weight'][0]])
-    urine_col = np.array(df_pat[VAR_IDS_EP['Urine_cum']])
-    urine_meas_arr = np.array(df_pat[URINE_CUM_NAME])
-    urine_reg_arr, urine_binary_arr = utils.future_urine_output(urine_col, urine_meas_arr, weight_col, rhours=2)
-    urine_reg_arr = utils.convolve_hr(urine_reg_arr, hr_status_arr)
-    urine_binary_arr = utils.convolve_hr(urine_binary_arr, hr_status_arr)
-    output_df_dict[URINE_REG_NAME] = urine_reg_arr
-    output_df_dict[URINE_BINARY_NAME] = urine_binary_arr
+    weight_col = df_pat[VAR_IDS_EP['Weight'][0]].to_numpy(dtype=np.float32, copy=False)
+    urine_col = df_pat[VAR_IDS_EP['Urine_cum']].to_numpy(dtype=np.float32, copy=False)
+    urine_meas_arr = df_pat[URINE_CUM_NAME].to_numpy(dtype=np.float32, copy=False)
+    urine_reg_arr, urine_binary_arr = kernels.future_urine_output(urine_col, urine_meas_arr, weight_col, 2)
 
     # Apache Score Phenotyping, predicted after the first 24h
     apache_arr = utils.unique_label_at_hours(stay_length, apache_group, at_hours=24)
-    apache_arr = utils.convolve_hr(apache_arr, hr_status_arr)
-    output_df_dict[PHENOTYPING_NAME] = apache_arr
 
     # Remaining length of stay, (Cont. regression)
-    rem_los = np.linspace(stay_length / STEPS_PER_HOUR, 0, num=stay_length)
-    rem_los = utils.convolve_hr(rem_los, hr_status_arr)
-    output_df_dict[LOS_NAME] = rem_los
-
-    output_df = pd.DataFrame(output_df_dict)
-    return output_df
-
-
-def label_gen_benchmark(batch_id, label_path, endpoint_path, imputed_path, static_path, horizon):
-    """Creation of base labels directly defined on the imputed data / endpoints for one batch"""
-    apache_ii_map = APACHE_2_MAP
-    apache_iv_map = APACHE_4_MAP
-    df_static = pd.read_parquet(static_path)
-    all_out_dfs = []
-    delete_if_exist(os.path.join(label_path, "batch_{}.parquet".format(batch_id)))
-
-    patient_path = os.path.join(imputed_path, "batch_{}.parquet".format(batch_id))
-    df_all_pats = pd.read_parquet(patient_path)
-    all_pids = df_all_pats[PID].unique()
-    logging.info("Number of selected PIDs: {}".format(len(all_pids)))
-
-    cand_files = glob.glob(os.path.join(endpoint_path, "batch_{}.parquet".format(batch_id)))
-    assert (len(cand_files) == 1)
-    endpoint_path = cand_files[0]
-    df_all_endpoints = pd.read_parquet(endpoint_path)
-    logging.info("Number of patient IDs: {}".format(len(all_pids)))
+    rem_los = remaining_los(stay_length)
 
-    n_skipped_patients = 0
-    for pidx, pid in enumerate(all_pids):
+    # All labels are masked by the HR status in a single pass
+    label_names = [MORTALITY_NAME, CIRC_FAILURE_NAME + '_' + str(horizon) + 'Hours',
+                   RESP_FAILURE_NAME + '_' + str(horizon) + 'Hours', URINE_REG_NAME, URINE_BINARY_NAME,
+                   PHENOTYPING_NAME, LOS_NAME]
+    label_arrs = np.array([dynamic_mort_arr, dynamic_circ_failure, dynamic_resp_failure, urine_reg_arr,
+                           urine_binary_arr, apache_arr, rem_los], dtype=np.float32)
+    utils.convolve_hr_2d(label_arrs, hr_status_arr, out=label_arrs)
 
-        try:
-            mort_code = str(df_static[df_static[PID] == pid][DISCHARGE_NAME].values[0])
-            mort_status = mort_code == "dead"
-        except ValueError:
-            mort_status = False
-        except TypeError:
-            mort_status = False
-
-        apache_ii_group = float(df_static[df_static[PID] == pid][APACHE_2_NAME])
-        apache_iv_group = float(df_static[df_static[PID] == pid][APACHE_4_NAME])
-        apache_pat_group = utils.merge_apache_groups(apache_ii_group, apache_iv_group,
-                                                     apache_ii_map, apache_iv_map)
-
-        # Checks patient information is sufficient
-        if not os.path.exists(patient_path):
-            logging.info("WARNING: Patient {} does not exists, skipping...".format(pid))
-            n_skipped_patients += 1
-            continue
-
-        try:
-            df_endpoint = df_all_endpoints[df_all_endpoints[PID] == pid]
-        except:
-            logging.info("WARNING: Issue while reading endpoints of patient {}".format(pid))
-            n_skipped_patients += 1
-            continue
+    output_df_dict = {}
+    output_df_dict[DATETIME] = abs_time_col
+    output_df_dict[REL_DATETIME] = rel_time_col
+    output_df_dict[PID] = patient_col
+    output_df_dict.update(zip(label_names, label_arrs))
 
-        df_pat = df_all_pats[df_all_pats[PID] == pid]
+    # Mortality and APACHE group are small integer classes, stored as nullable int8
+    for name in CLASS_LABEL_NAMES:
+        output_df_dict[name] = pa.array(output_df_dict[name], from_pandas=True).cast(pa.int8())
 
-        if df_pat.shape[0] == 0 or df_endpoint.shape[0] == 0:
-            if df_pat.shape[0] == 0:
-                logging.info("WARNING: Empty endpoints", flush=True)
-            else:
-                logging.info("WARNING: Empty imputed data in patient {}".format(pid), flush=True)
+    # Labels are kept as arrow tables up to the parquet writer, no data-frame is built per patient
+    return pa.Table.from_pydict(output_df_dict)
 
-            n_skipped_patients += 1
-            continue
 
-        if not is_df_sorted(df_endpoint, DATETIME):
-            df_endpoint = df_endpoint.sort_values(by=DATETIME, kind="mergesort")
+def gen_label_task(task):
+    """Generates the labels of one patient task, returns the patient ID with its label table"""
+    df_pat, df_endpoint, mort_status, apache_group, pid, horizon, debug_mode = task
+    table_label = gen_label(df_pat, df_endpoint, mort_status=mort_status, apache_group=apache_group, pid=pid,
+                            horizon=horizon, debug_mode=debug_mode)
+    if table_label is not None:
+        assert (table_label.num_rows == df_pat.shape[0])
+    return pid, table_label
 
-        # Generates labels for patient
-        df_label = gen_label(df_pat, df_endpoint, mort_status=mort_status, apache_group=apache_pat_group, pid=pid,
-                             horizon=horizon)
 
-        if df_label is None:
-            logging.info("WARNING: Label could not be created for PID: {}".format(pid))
-            n_skipped_patients += 1
-            continue
+def map_in_chunks(executor, fn, tasks, workers, chunk_size=PATIENT_CHUNK_SIZE):
+    """Maps a function over tasks with an executor, submitting at most chunk_size tasks at once"""
+    while True:
+        chunk = list(itertools.islice(tasks, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield from executor.map(fn, chunk, chunksize=max(1, len(chunk) // (4 * workers)))
 
-        assert (df_label.shape[0] == df_pat.shape[0])
 
-        all_out_dfs.append(df_label)
+def label_gen_benchmark(batch_id, label_path, endpoint_path, imputed_path, static_path, horizon, debug_mode=False,
+                        workers=1):
+    """Creation of base labels directly defined on the imputed data / endpoints for one batch
 
-        gc.collect()
+    With workers > 1 the patients of the batch are labelled in a process pool. generate_labels uses it when there is
+    a single batch, several batches are processed in parallel instead.
+    """
+    apache_ii_map = APACHE_2_MAP
+    apache_iv_map = APACHE_4_MAP
+    df_static = pd.read_parquet(static_path, columns=STATIC_COLUMNS)
+    output_path = os.path.join(label_path, "batch_{}.parquet".format(batch_id))
+    delete_if_exist(output_path)
 
-        if (pidx + 1) % 100 == 0:
-            logging.info("Progress for batch {}: {:.2f} %".format(batch_id, (pidx + 1) / len(all_pids) * 100))
-            logging.info("Number of skipped patients: {}".format(n_skipped_patients))
+    patient_path = os.path.join(imputed_path, "batch_{}.parquet".format(batch_id))
+    all_pids = read_contiguous_pids(patient_path)
+    logging.info("Number of selected PIDs: %d", len(all_pids))
 
-    combined_df = pd.concat(all_out_dfs, axis=0)
-    output_path = os.path.join(label_path, "batch_{}.parquet".format(batch_id))
-    combined_df.to_parquet(output_path)
+    cand_files = glob.glob(os.path.join(endpoint_path, "batch_{}.parquet".format(batch_id)))
+    assert (len(cand_files) == 1)
+    endpoint_path = cand_files[0]
+    endpoint_pids = set(read_contiguous_pids(endpoint_path).tolist())
+
+    # Static information is looked up by row index rather than by scanning the table for every patient
+    pid_to_row = {static_pid: row for row, static_pid in enumerate(df_static[PID].values)}
+    mort_arr = df_static[DISCHARGE_NAME].astype(str).values == "dead"
+    apache_ii_arr = df_static[APACHE_2_NAME].to_numpy(dtype=np.float64, copy=False)
+    apache_iv_arr = df_static[APACHE_4_NAME].to_numpy(dtype=np.float64, copy=False)
+
+    # Patients without endpoints or static data are skipped up-front
+    n_all_pids = len(all_pids)
+    all_pids = [pid for pid in all_pids.tolist() if pid in endpoint_pids and pid in pid_to_row]
+    n_skipped_patients = n_all_pids - len(all_pids)
+    logging.info("Number of patient IDs: %d, skipped for missing endpoints or static data: %d", len(all_pids),
+                 n_skipped_patients)
+
+    # Both batch files are streamed patient by patient instead of being loaded in memory at once, and sorted in time
+    # per record batch rather than per patient
+    pat_groups = PatientFrameStream(patient_path, IMPUTED_COLUMNS, sort_by=DATETIME, pids=all_pids)
+    endpoint_groups = PatientFrameStream(endpoint_path, ENDPOINT_COLUMNS, sort_by=DATETIME, pids=all_pids)
+
+    def _patient_tasks():
+        for pid in all_pids:
+            static_row = pid_to_row[pid]
+            mort_status = mort_arr[static_row]
+            apache_ii_group = apache_ii_arr[static_row]
+            apache_iv_group = apache_iv_arr[static_row]
+            apache_pat_group = utils.merge_apache_groups(apache_ii_group, apache_iv_group,
+                                                         apache_ii_map, apache_iv_map)
+
+            df_endpoint = endpoint_groups.get(pid)
+            df_pat = pat_groups.get(pid)
+
+            if debug_mode:
+                assert is_df_sorted(df_pat, DATETIME) and is_df_sorted(df_endpoint, DATETIME)
+
+            yield df_pat, df_endpoint, mort_status, apache_pat_group, pid, horizon, debug_mode
+
+    # Workers are spawned rather than forked as the batch files are read in a background thread
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) \
+        if workers > 1 else None
+    if executor is None:
+        label_results = map(gen_label_task, _patient_tasks())
+    else:
+        label_results = map_in_chunks(executor, gen_label_task, _patient_tasks(), workers)
+
+    # Labels are written as they are computed, patients are buffered to form row groups of WRITE_ROW_GROUP_SIZE rows
+    writer = None
+    buffered_tables = []
+    n_buffered_rows = 0
+    completed = False
+    try:
+        for pidx, (pid, table_label) in enumerate(label_results):
+
+            if (pidx + 1) % 100 == 0:
+                logging.info("Progress for batch %s: %.2f %%, number of skipped patients: %d", batch_id,
+                             (pidx + 1) / len(all_pids) * 100, n_skipped_patients)
+
+            if table_label is None:
+                logging.info("WARNING: Label could not be created for PID: %s", pid)
+                n_skipped_patients += 1
+                continue
+
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table_label.schema, compression="zstd", compression_level=3,
+                                          use_dictionary=CLASS_LABEL_NAMES + [URINE_BINARY_NAME])
+            elif not table_label.schema.equals(writer.schema):
+                table_label = table_label.cast(writer.schema)
+            buffered_tables.append(table_label)
+            n_buffered_rows += table_label.num_rows
+
+            if n_buffered_rows >= WRITE_ROW_GROUP_SIZE:
+                writer.write_table(pa.concat_tables(buffered_tables), row_group_size=n_buffered_rows)
+                buffered_tables = []
+                n_buffered_rows = 0
+
+        if len(buffered_tables) > 0:
+            writer.write_table(pa.concat_tables(buffered_tables), row_group_size=n_buffered_rows)
+        completed = True
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if writer is not None:
+            writer.close()
+        # A failed batch does not leave a partial label file behind
+        if not completed:
+            delete_if_exist(output_path)
+
+    if writer is None:
+        logging.info("WARNING: No labels could be created for batch %s", batch_id)
@@ -37,6 +37,16 @@ def convolve_hr(in_arr, hr_status_arr):
     return out_arr
 
 
+def convolve_hr_2d(in_arr, hr_status_arr, out=None):
+    """ Convolve each row of a 2D array with a HR status arr, into out if given (which can be in_arr itself)"""
+    if out is None:
+        out = np.copy(in_arr)
+    elif out is not in_arr:
+        out[:] = in_arr
+    out[:, hr_status_arr == 0] = np.nan
+    return out
+
+
 def transition_to_abs(score_arr, target, lhours, rhours):
     """ Transition to an absolute value from a value below the target"""
     out_arr = np.zeros_like(score_arr)
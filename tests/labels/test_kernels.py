@@ -0,0 +1,43 @@
+import pytest
+import numpy as np
+
+from icu_benchmarks.labels import kernels, utils
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.mark.parametrize("stay_length", (2, 5, 300))
+def test_get_hr_status(rng, stay_length):
+    hr_col = np.cumsum(rng.random(stay_length) < 0.5).astype(float)
+    assert np.array_equal(kernels.get_hr_status(hr_col), utils.get_hr_status(hr_col))
+
+
+@pytest.mark.parametrize("stay_length,lhours,rhours", ((1, 0, 12),
+                                                       (300, 0, 12),
+                                                       (300, 2, 4),
+                                                       (1000, 0, 8)))
+def test_transition_to_failure(rng, stay_length, lhours, rhours):
+    ann_col = rng.choice([0.0, 1.0, np.nan], size=stay_length, p=[0.9, 0.08, 0.02])
+    assert np.array_equal(kernels.transition_to_failure(ann_col, lhours, rhours),
+                          utils.transition_to_failure(ann_col, lhours, rhours), equal_nan=True)
+
+
+@pytest.mark.parametrize("stay_length,rhours", ((1, 2), (300, 2), (1000, 4)))
+def test_future_urine_output(rng, stay_length, rhours):
+    urine_col = rng.uniform(0, 10, stay_length)
+    urine_meas_arr = np.cumsum(rng.random(stay_length) < 0.1).astype(float)
+    weight_col = rng.uniform(40, 100, stay_length)
+    labels_reg, labels_binary = kernels.future_urine_output(urine_col, urine_meas_arr, weight_col, rhours)
+    expected_reg, expected_binary = utils.future_urine_output(urine_col, urine_meas_arr, weight_col, rhours)
+    assert np.allclose(labels_reg, expected_reg, equal_nan=True)
+    assert np.array_equal(labels_binary, expected_binary, equal_nan=True)
+
+
+def test_transition_to_failure_float32(rng):
+    ann_col = rng.choice([0.0, 1.0, np.nan], size=500, p=[0.9, 0.08, 0.02])
+    labels = kernels.transition_to_failure(ann_col.astype(np.float32), 0, 12)
+    assert labels.dtype == np.float32
+    assert np.array_equal(labels, utils.transition_to_failure(ann_col, 0, 12), equal_nan=True)
@@ -1,10 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pytest
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from icu_benchmarks.common.constants import STEPS_PER_HOUR
-from icu_benchmarks.labels import utils
+from icu_benchmarks.common.constants import STEPS_PER_HOUR, PID, DATETIME, REL_DATETIME, HR_CUM_NAME, \
+    URINE_CUM_NAME, VAR_IDS_EP, DISCHARGE_NAME, APACHE_2_NAME, APACHE_4_NAME, APACHE_2_MAP, APACHE_4_MAP, \
+    MORTALITY_NAME, CIRC_FAILURE_NAME, RESP_FAILURE_NAME, URINE_REG_NAME, URINE_BINARY_NAME, PHENOTYPING_NAME, \
+    LOS_NAME
+from icu_benchmarks.data import labels as data_labels
+from icu_benchmarks.labels import utils, label_benchmark
 
 TEST_ROOT = Path(__file__).parent.parent
 
@@ -146,3 +154,288 @@ def test_get_any_resp_label():
     any_resp = utils.get_any_resp_label(test_resp).astype(float)
     assert np.all(any_resp[:3] == 1.0)
     assert np.isnan(any_resp[-1])
+
+
+@pytest.mark.parametrize("batch_size", (1, 4, 100))
+def test_iter_patient_frames(tmp_path, batch_size):
+    df = pd.DataFrame({PID: [3, 3, 3, 1, 2, 2, 2, 2, 2], DATETIME: np.arange(9), 'value': np.arange(9) * 2.0})
+    path = tmp_path / 'batch_0.parquet'
+    df.to_parquet(path)
+
+    frames = list(label_benchmark.iter_patient_frames(path, [PID, DATETIME, 'value'], batch_size=batch_size))
+
+    assert [pid for pid, _ in frames] == [3, 1, 2]
+    for pid, df_pat in frames:
+        pd.testing.assert_frame_equal(df_pat.reset_index(drop=True), df[df[PID] == pid].reset_index(drop=True))
+
+
+def test_iter_patient_frames_non_contiguous(tmp_path):
+    path = tmp_path / 'batch_0.parquet'
+    pd.DataFrame({PID: [1, 2, 1], DATETIME: np.arange(3)}).to_parquet(path)
+
+    with pytest.raises(ValueError):
+        list(label_benchmark.iter_patient_frames(path, [PID, DATETIME]))
+
+
+@pytest.mark.parametrize("pids,contiguous", (([], True),
+                                             ([3, 3, 1, 2, 2], True),
+                                             ([1, 2, 1], False),
+                                             ([1, 2, 1, 3], False)))
+def test_read_contiguous_pids(tmp_path, pids, contiguous):
+    path = tmp_path / 'batch_0.parquet'
+    pd.DataFrame({PID: np.array(pids, dtype=int), DATETIME: np.arange(len(pids))}).to_parquet(path)
+
+    if contiguous:
+        assert label_benchmark.read_contiguous_pids(path).tolist() == list(dict.fromkeys(pids))
+    else:
+        with pytest.raises(ValueError):
+            label_benchmark.read_contiguous_pids(path)
+
+
+def test_patient_frame_stream_out_of_order(tmp_path):
+    path = tmp_path / 'batch_0.parquet'
+    pd.DataFrame({PID: [1, 2, 2, 3], DATETIME: np.arange(4)}).to_parquet(path)
+    stream = label_benchmark.PatientFrameStream(path, [PID, DATETIME])
+
+    assert stream.get(3)[DATETIME].tolist() == [3]
+    assert stream.get(1)[DATETIME].tolist() == [0]
+    assert stream.get(4) is None
+    assert stream.get(2)[DATETIME].tolist() == [1, 2]
+
+
+def test_patient_frame_stream_skipped_pids(tmp_path):
+    path = tmp_path / 'batch_0.parquet'
+    pd.DataFrame({PID: [1, 2, 2, 3, 4], DATETIME: np.arange(5)}).to_parquet(path)
+    stream = label_benchmark.PatientFrameStream(path, [PID, DATETIME], pids=[1, 3, 4])
+
+    assert stream.get(3)[DATETIME].tolist() == [3]
+    assert stream.get(1)[DATETIME].tolist() == [0]
+    assert stream.get(2) is None
+    assert stream.get(4)[DATETIME].tolist() == [4]
+
+
+@pytest.mark.parametrize("values,expected", (([], True),
+                                             ([1], True),
+                                             ([1, 2, 2, 3], True),
+                                             ([1, 3, 2], False)))
+def test_is_df_sorted(values, expected):
+    df = pd.DataFrame({DATETIME: pd.to_datetime(values, unit='s')})
+    assert label_benchmark.is_df_sorted(df, DATETIME) == expected
+
+
+@pytest.mark.parametrize("batch_size", (2, 100))
+def test_iter_patient_frames_sort_by(tmp_path, batch_size):
+    path = tmp_path / 'batch_0.parquet'
+    pd.DataFrame({PID: [3, 3, 3, 1, 2, 2, 2], DATETIME: [2, 0, 1, 5, 1, 0, 3],
+                  'value': np.arange(7)}).to_parquet(path)
+
+    frames = dict(label_benchmark.iter_patient_frames(path, [PID, DATETIME, 'value'], batch_size=batch_size,
+                                                      sort_by=DATETIME))
+
+    assert frames[3]['value'].tolist() == [1, 2, 0]
+    assert frames[1]['value'].tolist() == [3]
+    assert frames[2]['value'].tolist() == [5, 4, 6]
+
+
+def test_convolve_hr_2d():
+    hr_status_arr = np.array([1.0, 0.0, 1.0, 0.0])
+    in_arr = np.arange(8, dtype=float).reshape(2, 4)
+    out_arr = utils.convolve_hr_2d(in_arr, hr_status_arr)
+    for row_in, row_out in zip(in_arr, out_arr):
+        assert np.array_equal(row_out, utils.convolve_hr(row_in, hr_status_arr), equal_nan=True)
+    assert not np.isnan(in_arr).any()
+
+
+def test_convolve_hr_2d_out():
+    hr_status_arr = np.array([1.0, 0.0, 1.0, 0.0])
+    in_arr = np.arange(8, dtype=np.float32).reshape(2, 4)
+    expected = utils.convolve_hr_2d(in_arr, hr_status_arr)
+
+    out_arr = np.zeros_like(in_arr)
+    assert utils.convolve_hr_2d(in_arr, hr_status_arr, out=out_arr) is out_arr
+    assert np.array_equal(out_arr, expected, equal_nan=True)
+    assert not np.isnan(in_arr).any()
+
+    assert utils.convolve_hr_2d(in_arr, hr_status_arr, out=in_arr) is in_arr
+    assert np.array_equal(in_arr, expected, equal_nan=True)
+
+
+def write_label_batch(root, stay_hours, discharge_status, shuffled_pids=(), pid_order=None):
+    """Writes a fake imputed / endpoint / static batch, returns the patient data-frames by PID"""
+    rng = np.random.default_rng(0)
+    df_pats, df_endpoints, static_rows = {}, {}, []
+    for pid, (hours, status) in enumerate(zip(stay_hours, discharge_status), start=1):
+        stay_length = hours * STEPS_PER_HOUR
+        datetimes = pd.date_range('2020-01-01', periods=stay_length, freq='5min')
+        df_pats[pid] = pd.DataFrame({PID: pid, DATETIME: datetimes, REL_DATETIME: np.arange(stay_length) * 300.0,
+                                     HR_CUM_NAME: np.cumsum(rng.random(stay_length) < 0.7).astype(float),
+                                     URINE_CUM_NAME: np.cumsum(rng.random(stay_length) < 0.1).astype(float),
+                                     VAR_IDS_EP['Weight'][0]: rng.uniform(50, 100, stay_length),
+                                     VAR_IDS_EP['Urine_cum']: rng.uniform(0, 80, stay_length),
+                                     'vm2': rng.normal(size=stay_length)})
+        df_endpoints[pid] = pd.DataFrame({PID: pid, DATETIME: datetimes,
+                                          'circ_failure_status': rng.choice([0.0, 1.0, np.nan], size=stay_length,
+                                                                            p=[0.85, 0.1, 0.05]),
+                                          'resp_failure_status': rng.choice(['event_0', 'event_1', 'event_3',
+                                                                             'UNKNOWN'], size=stay_length,
+                                                                            p=[0.8, 0.1, 0.05, 0.05])})
+        static_rows.append({PID: pid, DISCHARGE_NAME: status, APACHE_2_NAME: list(APACHE_2_MAP)[pid],
+                            APACHE_4_NAME: np.nan})
+
+    pid_order = pid_order or list(df_pats)
+    df_endpoint_file = pd.concat([df_endpoints[pid] for pid in pid_order])
+    for pid in shuffled_pids:
+        df_endpoint_file.loc[df_endpoint_file[PID] == pid] = df_endpoints[pid].sample(frac=1, random_state=0).values
+    for name in ['imputed', 'endpoints', 'labels']:
+        (root / name).mkdir()
+    pd.concat([df_pats[pid] for pid in pid_order]).to_parquet(root / 'imputed' / 'batch_0.parquet')
+    df_endpoint_file.to_parquet(root / 'endpoints' / 'batch_0.parquet')
+    pd.DataFrame(static_rows).to_parquet(root / 'static.parquet')
+    return df_pats, df_endpoints, pd.DataFrame(static_rows)
+
+
+def reference_labels(df_pat, df_endpoint, static_row, horizon):
+    """Labels of one patient computed with the reference implementations of utils"""
+    stay_length = df_pat.shape[0]
+    hr_status_arr = utils.get_hr_status(df_pat[HR_CUM_NAME].values)
+    apache_group = utils.merge_apache_groups(static_row[APACHE_2_NAME], static_row[APACHE_4_NAME],
+                                             APACHE_2_MAP, APACHE_4_MAP)
+    ann_resp_arr = utils.get_any_resp_label(df_endpoint['resp_failure_status'].values).astype(float)
+    urine_reg_arr, urine_binary_arr = utils.future_urine_output(df_pat[VAR_IDS_EP['Urine_cum']].values,
+                                                                df_pat[URINE_CUM_NAME].values,
+                                                                df_pat[VAR_IDS_EP['Weight'][0]].values, rhours=2)
+    labels = {MORTALITY_NAME: utils.unique_label_at_hours(stay_length, static_row[DISCHARGE_NAME] == 'dead'),
+              CIRC_FAILURE_NAME + '_' + str(horizon) + 'Hours':
+                  utils.transition_to_failure(df_endpoint['circ_failure_status'].values, 0, horizon),
+              RESP_FAILURE_NAME + '_' + str(horizon) + 'Hours': utils.transition_to_failure(ann_resp_arr, 0, horizon),
+              URINE_REG_NAME: urine_reg_arr,
+              URINE_BINARY_NAME: urine_binary_arr,
+              PHENOTYPING_NAME: utils.unique_label_at_hours(stay_length, apache_group),
+              LOS_NAME: np.linspace(stay_length / STEPS_PER_HOUR, 0, num=stay_length)}
+    return {name: utils.convolve_hr(arr, hr_status_arr) for name, arr in labels.items()}
+
+
+def run_label_batch(root, workers=1, debug_mode=False):
+    label_benchmark.label_gen_benchmark(0, root / 'labels', root / 'endpoints', root / 'imputed',
+                                        root / 'static.parquet', horizon=12, workers=workers, debug_mode=debug_mode)
+    return pd.read_parquet(root / 'labels' / 'batch_0.parquet')
+
+
+def test_label_gen_benchmark(tmp_path):
+    # Patient 2 stays less than 24h and has its endpoints out of time order
+    df_pats, df_endpoints, df_static = write_label_batch(tmp_path, stay_hours=[30, 10, 26],
+                                                         discharge_status=['alive', 'dead', 'dead'],
+                                                         shuffled_pids=[2])
+    df_label = run_label_batch(tmp_path)
+
+    # Class labels are stored as int8, and read back by pandas as floats with NaN for missing labels
+    schema = pq.read_schema(tmp_path / 'labels' / 'batch_0.parquet')
+    for name in [MORTALITY_NAME, PHENOTYPING_NAME]:
+        assert schema.field(name).type == pa.int8()
+        assert pd.api.types.is_float_dtype(df_label[name])
+        assert df_label[name].isna().any() and df_label[name].notna().any()
+
+    assert df_label[PID].tolist() == [pid for pid in df_pats for _ in range(df_pats[pid].shape[0])]
+    for pid, df_pat in df_pats.items():
+        df_label_pat = df_label[df_label[PID] == pid]
+        assert np.array_equal(df_label_pat[DATETIME].values, df_pat[DATETIME].values)
+        assert np.array_equal(df_label_pat[REL_DATETIME].values, df_pat[REL_DATETIME].values)
+        expected = reference_labels(df_pat, df_endpoints[pid], df_static.iloc[pid - 1], horizon=12)
+        for name, expected_arr in expected.items():
+            assert np.allclose(df_label_pat[name].values, expected_arr, equal_nan=True, rtol=1e-5), name
+
+
+def test_label_gen_benchmark_workers(tmp_path):
+    write_label_batch(tmp_path, stay_hours=[30, 10, 26, 4], discharge_status=['alive', 'dead', 'dead', None],
+                      shuffled_pids=[2])
+    df_label = run_label_batch(tmp_path, workers=1)
+
+    pd.testing.assert_frame_equal(run_label_batch(tmp_path, workers=2), df_label)
+
+
+@pytest.mark.parametrize("row_group_size", (300, label_benchmark.WRITE_ROW_GROUP_SIZE))
+def test_label_gen_benchmark_row_groups(tmp_path, monkeypatch, row_group_size):
+    monkeypatch.setattr(label_benchmark, 'WRITE_ROW_GROUP_SIZE', row_group_size)
+    write_label_batch(tmp_path, stay_hours=[30, 10, 26, 4, 12], discharge_status=['alive'] * 5)
+    df_label = run_label_batch(tmp_path)
+
+    metadata = pq.ParquetFile(tmp_path / 'labels' / 'batch_0.parquet').metadata
+    assert metadata.num_rows == df_label.shape[0]
+    assert metadata.num_row_groups <= df_label.shape[0] // row_group_size + 1
+    for idx in range(metadata.num_row_groups - 1):
+        assert metadata.row_group(idx).num_rows >= row_group_size
+
+
+def test_label_gen_benchmark_debug_mode(tmp_path):
+    write_label_batch(tmp_path, stay_hours=[30, 10, 26], discharge_status=['alive', 'dead', 'dead'],
+                      shuffled_pids=[2])
+    df_label = run_label_batch(tmp_path)
+
+    pd.testing.assert_frame_equal(run_label_batch(tmp_path, debug_mode=True), df_label)
+
+
+def edit_endpoints(root, edit_fn):
+    path = root / 'endpoints' / 'batch_0.parquet'
+    edit_fn(pd.read_parquet(path)).to_parquet(path)
+
+
+def test_label_gen_benchmark_length_mismatch(tmp_path):
+    write_label_batch(tmp_path, stay_hours=[2, 2, 2], discharge_status=['alive'] * 3)
+    edit_endpoints(tmp_path, lambda df: df[np.arange(len(df)) != np.flatnonzero(df[PID].values == 2)[-1]])
+
+    with pytest.raises(ValueError, match="Patient 2"):
+        run_label_batch(tmp_path)
+
+
+def test_label_gen_benchmark_debug_mode_misaligned(tmp_path):
+    write_label_batch(tmp_path, stay_hours=[2, 2, 2], discharge_status=['alive'] * 3)
+
+    def _shift_patient_2(df):
+        df.loc[df[PID] == 2, DATETIME] += pd.Timedelta(minutes=1)
+        return df
+
+    edit_endpoints(tmp_path, _shift_patient_2)
+    run_label_batch(tmp_path)
+    with pytest.raises(AssertionError):
+        run_label_batch(tmp_path, debug_mode=True)
+
+
+def test_generate_labels_single_batch(tmp_path):
+    write_label_batch(tmp_path, stay_hours=[30, 10, 26], discharge_status=['alive', 'dead', 'dead'])
+    df_label = run_label_batch(tmp_path)
+
+    # A single batch is labelled with a patient process pool
+    output_dir = tmp_path / 'generated_labels'
+    data_labels.generate_labels(tmp_path / 'endpoints', tmp_path / 'imputed', tmp_path / 'static.parquet', output_dir,
+                                nr_workers=2, horizon=12)
+
+    pd.testing.assert_frame_equal(pd.read_parquet(output_dir / 'batch_0.parquet'), df_label)
+
+
+def test_map_in_chunks():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = label_benchmark.map_in_chunks(executor, abs, iter(range(-7, 0)), workers=2, chunk_size=3)
+        assert list(results) == list(range(7, 0, -1))
+
+
+def test_label_gen_benchmark_non_contiguous(tmp_path):
+    write_label_batch(tmp_path, stay_hours=[2, 2, 2], discharge_status=['alive'] * 3, pid_order=[1, 2, 1, 3])
+
+    with pytest.raises(ValueError):
+        run_label_batch(tmp_path)
+    assert not (tmp_path / 'labels' / 'batch_0.parquet').exists()
+
+
+def test_label_gen_benchmark_failure_removes_output(tmp_path, monkeypatch):
+    write_label_batch(tmp_path, stay_hours=[2, 2, 2], discharge_status=['alive'] * 3)
+    gen_label = label_benchmark.gen_label
+
+    def _failing_gen_label(df_pat, df_endpoint, horizon, pid=None, **kwargs):
+        if pid == 3:
+            raise RuntimeError("Labelling failed")
+        return gen_label(df_pat, df_endpoint, horizon, pid=pid, **kwargs)
+
+    monkeypatch.setattr(label_benchmark, 'gen_label', _failing_gen_label)
+    with pytest.raises(RuntimeError):
+        run_label_batch(tmp_path)
+    assert not (tmp_path / 'labels' / 'batch_0.parquet').exists()